@@ -3,6 +3,10 @@
 See README.rst."""
 
 
+import contextlib
+import os
+from typing import Any, Callable, ContextManager, TypeVar
+
 from .time_block import TimeBlock, logger
 
 __author__ = "Samuel Grayson"
@@ -21,8 +25,39 @@ get_stats = _time_block.get_stats
 format_stats = _time_block.format_stats
 disable_stderr = _time_block.disable_stderr
 enable_stderr = _time_block.enable_stderr
+set_default_measure_mem = _time_block.set_default_measure_mem
+set_async_mode = _time_block.set_async_mode
 _enable_doctest_logging = _time_block._enable_doctest_logging
 
+_Function = TypeVar("_Function", bound=Callable[..., Any])
+
+
+class _NullCtx(contextlib.ContextDecorator, contextlib.nullcontext):
+    # Like the real ctx, usable both in a with-statement and as a decorator.
+    pass
+
+
+_null_ctx = _NullCtx()
+
+
+def _noop_ctx(*args: Any, **kwargs: Any) -> ContextManager[None]:
+    return _null_ctx
+
+
+def _noop_decor(*args: Any, **kwargs: Any) -> Callable[[_Function], _Function]:
+    return _identity
+
+
+def _identity(func: _Function) -> _Function:
+    return func
+
+
+if os.environ.get("CH_TIME_BLOCK_DISABLED", "") not in ("", "0"):
+    # Bound at import time, so disabled code does not even pay for a wrapper frame.
+    ctx = _noop_ctx  # type: ignore
+    decor = _noop_decor  # type: ignore
+    adecor = _noop_decor  # type: ignore
+
 enable_stderr()
 
 __all__ = ["TimeBlock", "logger"]
@@ -3,19 +3,19 @@ from __future__ import annotations
 import asyncio
 import collections
 import contextlib
-import copy
-import datetime
 import functools
 import gc
+import inspect
 import logging
+import os
 import sys
 import threading
-from collections import defaultdict
+import time
 from typing import (
     Any,
     Awaitable,
     Callable,
-    DefaultDict,
+    ContextManager,
     Dict,
     Generator,
     List,
@@ -28,7 +28,7 @@ from typing import (
 
 import psutil  # type: ignore
 
-from .utils import mean, mem2str, python_sanitize, stddev
+from .utils import RunningStats, mem2str
 
 
 def safe_current_task() -> Optional[Any]:
@@ -38,10 +38,24 @@ def safe_current_task() -> Optional[Any]:
         return None
 
 
+_STACK_POOL_SIZE = 128
+# flush pending records at least this often, even inside a long outer block
+_MAX_PENDING = 256
+_MAX_PENDING_NS = 100_000_000
+
+
 class TimeBlockData(threading.local):
     def __init__(self, initial_stack: List[str], use_task_name: bool = False) -> None:
         super().__init__()
-        self.stacks: DefaultDict[int, List[str]] = defaultdict(self.initial_stack)
+        self.stacks: Dict[int, List[str]] = {}
+        # stats key (stack without the root) of the innermost block, per task
+        self.keys: Dict[int, Tuple[str, ...]] = {}
+        # stacks of finished tasks, kept for reuse by new tasks
+        self.stack_pool: List[List[str]] = []
+        # (clear epoch, key, duration, mem) records not yet merged into TimeBlock.stats
+        self.pending: List[Tuple[int, Tuple[str, ...], float, int]] = []
+        # perf_counter_ns of the last flush of pending
+        self.last_flush = 0
         self.initial_stack_ = initial_stack
         self.use_task_name = use_task_name
 
@@ -51,29 +65,128 @@ class TimeBlockData(threading.local):
     def __setstate__(self, state: Mapping[str, Any]) -> None:
         self.__dict__.update(state)
 
-    def initial_stack(self) -> List[str]:
-        if self.use_task_name:
-            task = safe_current_task()
-            return [task.get_name()] if task else self.initial_stack_[:]
+    def initial_stack(self, task: Optional[Any]) -> List[str]:
+        stack = self.stack_pool.pop() if self.stack_pool else []
+        if self.use_task_name and task is not None:
+            stack.append(task.get_name())
         else:
-            return self.initial_stack_[:]
-
-    @property
-    def stack(self) -> List[str]:
-        task = safe_current_task()
-        task_id = id(task) if task is not None else 0
-        return self.stacks[task_id]
+            stack.extend(self.initial_stack_)
+        return stack
+
+    def get_stack(self, task_id: int, task: Optional[Any]) -> List[str]:
+        stack = self.stacks.get(task_id)
+        if stack is None:
+            stack = self.initial_stack(task)
+            self.stacks[task_id] = stack
+            if task is not None:
+                # Otherwise, stacks grows with every task ever run, and a
+                # new task could reuse the id (and stale stack) of a dead one.
+                task.add_done_callback(functools.partial(self.drop_stack, task_id))
+        return stack
+
+    def drop_stack(self, task_id: int, _task: Any = None) -> None:
+        stack = self.stacks.pop(task_id, None)
+        self.keys.pop(task_id, None)
+        if stack is not None and len(self.stack_pool) < _STACK_POOL_SIZE:
+            stack.clear()
+            self.stack_pool.append(stack)
 
 
 FunctionType = TypeVar("FunctionType", bound=Callable[..., Any])
 AsyncFunctionType = TypeVar("AsyncFunctionType", bound=Callable[..., Awaitable[Any]])
 
+
+class _Name(str):
+    # repr is the bare name, so str(signature) refers to a variable holding the default.
+    def __repr__(self) -> str:
+        return str(self)
+
+
+def specialized_wrapper(
+    func: Callable[..., Any], make_ctx: Callable[[], ContextManager[None]]
+) -> Optional[Callable[..., Any]]:
+    """Compile a wrapper with `func`'s parameters that calls it inside `make_ctx()`.
+
+    Forwarding named parameters avoids packing and unpacking `*args`
+    and `**kwargs` on every call. Returns None if the signature is not
+    available or cannot be reproduced.
+
+    Unlike a `*args, **kwargs` wrapper, this rejects a call with bad
+    arguments before entering the block, so such calls are not
+    recorded.
+
+    """
+    try:
+        sig = inspect.signature(func, follow_wrapped=False)
+    except (TypeError, ValueError):
+        return None
+    namespace: Dict[str, Any] = {"__ch_ctx": make_ctx, "__ch_func": func}
+    params: List[inspect.Parameter] = []
+    args: List[str] = []
+    for param in sig.parameters.values():
+        if param.name in namespace:
+            return None
+        if param.default is not param.empty:
+            default_name = _Name(f"__ch_default_{param.name}")
+            namespace[default_name] = param.default
+            param = param.replace(default=default_name)
+        params.append(param.replace(annotation=param.empty))
+        if param.kind is param.VAR_POSITIONAL:
+            args.append(f"*{param.name}")
+        elif param.kind is param.KEYWORD_ONLY:
+            args.append(f"{param.name}={param.name}")
+        elif param.kind is param.VAR_KEYWORD:
+            args.append(f"**{param.name}")
+        else:
+            args.append(param.name)
+    src = "\n".join(
+        [
+            f"def timed_func{inspect.Signature(params)}:",
+            "    with __ch_ctx():",
+            f"        return __ch_func({', '.join(args)})",
+        ]
+    )
+    try:
+        # src is built only from func's parameter names, not from user strings.
+        exec(  # pylint: disable=exec-used
+            compile(src, f"<timed {func.__qualname__}>", "exec"), namespace
+        )
+    except SyntaxError:
+        return None
+    return cast(
+        Callable[..., Any], functools.update_wrapper(namespace["timed_func"], func)
+    )
+
+
+def check_gc_generation(gc_generation: int) -> None:
+    if not 0 <= gc_generation <= 2:
+        raise ValueError(f"gc_generation must be 0, 1, or 2, not {gc_generation!r}")
+
+
+_STATM = "/proc/self/statm"
+_HAS_STATM = sys.platform.startswith("linux") and os.path.exists(_STATM)
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if _HAS_STATM else 0
+
 logger = logging.getLogger("charmonium.logger")
 logger.setLevel(logging.DEBUG)
 
 
 class TimeBlock:
-    def __init__(self, root_label: str = "") -> None:
+    def __init__(
+        self, root_label: str = "", detailed: bool = True, async_mode: bool = True
+    ) -> None:
+        """
+
+        If `detailed`, every (duration, mem) sample is kept so that
+        `get_stats` can return them. Otherwise, only running
+        aggregates are kept, which use constant memory per block
+        name; see `get_summary`.
+
+        If `async_mode` is False, blocks are not tracked per asyncio
+        task, which saves a task lookup on every entry. Only use this
+        if blocks are never timed from concurrent coroutines.
+
+        """
         if not root_label:
             if threading.current_thread() is threading.main_thread():
                 root_label = ""
@@ -81,29 +194,118 @@ class TimeBlock:
                 root_label = "Thread " + threading.current_thread().name
         self.data = TimeBlockData([root_label])
         self.lock = threading.RLock()
-        self.stats: Dict[
-            Tuple[str, ...], List[Tuple[float, int]]
-        ] = collections.defaultdict(list)
+        self.detailed = detailed
+        self.async_mode = async_mode
+        self.stats: Dict[Tuple[str, ...], RunningStats] = collections.defaultdict(
+            functools.partial(RunningStats, detailed)
+        )
         self.logger = logger
         self.handler = logging.StreamHandler(sys.stdout)
         self.handler.setFormatter(logging.Formatter("%(message)s"))
+        self._proc_pid = 0
+        self._proc: Optional[psutil.Process] = None
+        self.measure_mem = True
+        # bumped by clear, so records buffered before it are dropped on flush
+        self.epoch = 0
 
     def __getstate__(self) -> Mapping[str, Any]:
         return {
             "stats": self.stats,
             "data": self.data,
+            "measure_mem": self.measure_mem,
+            "detailed": self.detailed,
+            "async_mode": self.async_mode,
         }
 
     def __setstate__(self, state: Mapping[str, Any]) -> None:
         self.stats = state["stats"]
         self.data = state["data"]
+        self._proc_pid = 0
+        self._proc = None
+        self.measure_mem = state.get("measure_mem", True)
+        self.detailed = state.get("detailed", True)
+        self.async_mode = state.get("async_mode", True)
+        self.epoch = 0
+
+    def _process(self) -> psutil.Process:
+        # psutil.Process() is not free, so build it on first use (it is
+        # not needed at all where _rss reads /proc) and reuse it unless we
+        # have forked.
+        pid = os.getpid()
+        if self._proc is None or pid != self._proc_pid:
+            self._proc = psutil.Process()
+            self._proc_pid = pid
+        return self._proc
+
+    def _rss(self) -> int:
+        if _HAS_STATM:
+            # psutil reads the same file on Linux; skip its wrapping.
+            fd = os.open(_STATM, os.O_RDONLY)
+            try:
+                return int(os.read(fd, 128).split()[1]) * _PAGE_SIZE
+            finally:
+                os.close(fd)
+        else:
+            return self._process().memory_info().rss
+
+    def _flush(self) -> None:
+        pending = self.data.pending
+        if pending:
+            with self.lock:
+                for epoch, key, duration, mem in pending:
+                    if epoch == self.epoch:
+                        self.stats[key].add(duration, mem)
+            pending.clear()
+        self.data.last_flush = time.perf_counter_ns()
 
     def get_stats(self) -> Dict[Tuple[str, ...], List[Tuple[float, int]]]:
-        """Gets the stats for a specific function."""
+        """Gets the stats for a specific function.
+
+        This requires `detailed`; see also `get_summary`.
+
+        Blocks nested inside a still-running block on another thread
+        are merged when that thread's outermost block exits, or at its
+        first block exit once 256 records are buffered or 0.1s has
+        passed since its last merge. Until then they are not included.
+
+        """
+        if not self.detailed:
+            raise ValueError(
+                "get_stats requires TimeBlock(detailed=True); use get_summary instead"
+            )
+        self._flush()
+        # need lock to get consistent view of stats
+        with self.lock:
+            # need to copy the lists so returned object doesn't change
+            # (the tuples inside are immutable, so they can be shared)
+            return {key: list(acc.samples) for key, acc in self.stats.items()}
+
+    def get_summary(
+        self,
+    ) -> Dict[Tuple[str, ...], Tuple[int, float, float, float, float]]:
+        """Gets the aggregate stats for each function.
+
+        Each value is (n_calls, time mean, time stddev, mem mean, mem stddev).
+
+        Blocks nested inside a still-running block on another thread
+        are merged when that thread's outermost block exits, or at its
+        first block exit once 256 records are buffered or 0.1s has
+        passed since its last merge. Until then they are not included.
+
+        """
+        self._flush()
         # need lock to get consistent view of stats
         with self.lock:
-            # need deepcopy so returned object doesn't change
-            return copy.deepcopy(dict(self.stats))
+            return {
+                key: (
+                    acc.n,
+                    acc.time_mean,
+                    acc.time_stddev(),
+                    acc.mem_mean,
+                    acc.mem_stddev(),
+                )
+                for key, acc in self.stats.items()
+            }
 
     @contextlib.contextmanager
     def ctx(
@@ -113,11 +315,19 @@ class TimeBlock:
         print_start: bool = True,
         print_stop: bool = True,
         do_gc: bool = False,
+        measure_mem: Optional[bool] = None,
+        gc_generation: int = 2,
     ) -> Generator[None, None, None]:
         """Measure the time and memory-usage of the wrapped context.
 
         If `do_gc`, then I will run garbage collection (with a
         separate timer). This makes memory usage stats more accurate.
+        `gc_generation` is passed to `gc.collect`; a lower generation
+        is faster on large heaps, but may miss older garbage.
+
+        If `measure_mem` is False, memory usage is not sampled and is
+        recorded as 0. This is cheaper for short blocks. If it is None,
+        use the default from `set_default_measure_mem`.
 
         >>> import charmonium.time_block as ch_time_block
         >>> ch_time_block._enable_doctest_logging()
@@ -134,33 +344,63 @@ class TimeBlock:
 
         """
 
-        self.data.stack.append(name + name_extra)
-        qualified_name_str = " > ".join(self.data.stack)
+        if do_gc:
+            # Check before pushing, so a bad value can't leave a stale frame.
+            check_gc_generation(gc_generation)
+        # Look up the task once; asyncio.current_task is not free.
+        task = safe_current_task() if self.async_mode else None
+        task_id = id(task) if task is not None else 0
+        stack = self.data.get_stack(task_id, task)
+        label = name + name_extra
+        stack.append(label)
+        parent_key = self.data.keys.get(task_id, ())
+        key = parent_key + (label,)
+        self.data.keys[task_id] = key
+        if (print_start or print_stop) and not (
+            self.logger.isEnabledFor(logging.DEBUG) and self.logger.hasHandlers()
+        ):
+            # Nobody would see the messages, so don't bother formatting them.
+            print_start = print_stop = False
+        qualified_name_str = " > ".join(stack) if print_start or print_stop else ""
         if print_start:
             self.logger.debug("%s: running", qualified_name_str)
         exc: Optional[Exception] = None
-        process = psutil.Process()
-        time_start = datetime.datetime.now()
-        mem_start = process.memory_info().rss
+        if measure_mem is None:
+            measure_mem = self.measure_mem
+        time_start = time.perf_counter_ns()
+        mem_start = self._rss() if measure_mem else 0
         try:
             yield
         except Exception as exc2:  # pylint: disable=broad-except
             exc = exc2
         finally:
-            time_stop = datetime.datetime.now()
-            duration = (time_stop - time_start).total_seconds()
+            time_stop = time.perf_counter_ns()
+            duration = (time_stop - time_start) * 1e-9
             if do_gc:
-                gc_start = datetime.datetime.now()
-                gc.collect()
-                gc_end = datetime.datetime.now()
-                gc_duration = (gc_end - gc_start).total_seconds()
+                gc_start = time.perf_counter_ns()
+                gc.collect(gc_generation)
+                gc_end = time.perf_counter_ns()
+                gc_duration = (gc_end - gc_start) * 1e-9
             else:
-                gc_duration = 0
-            mem_end = process.memory_info().rss
+                gc_duration = 0.0
+            mem_end = self._rss() if measure_mem else 0
             mem_leaked = mem_end - mem_start
-            with self.lock:
-                self.stats[tuple(self.data.stack[1:])].append((duration, mem_leaked))
-            self.data.stack.pop()
+            # Buffer locally and take the lock once per outermost block.
+            pending = self.data.pending
+            pending.append((self.epoch, key, duration, mem_leaked))
+            # If our task already finished (e.g. an async generator closed
+            # later from another task), its stack may have been reused.
+            # `task` is still referenced here, so its id cannot be reused.
+            if self.data.stacks.get(task_id) is stack:
+                stack.pop()
+                # Likewise, don't resurrect the key of a dropped task.
+                self.data.keys[task_id] = parent_key
+            if (
+                not parent_key
+                or len(pending) >= _MAX_PENDING
+                or time_stop - self.data.last_flush >= _MAX_PENDING_NS
+            ):
+                self._flush()
             if print_stop:
                 mem_val, mem_unit, _ = mem2str(mem_leaked)
                 self.logger.debug(
@@ -181,8 +421,30 @@ class TimeBlock:
         print_stop: bool = True,
         print_args: bool = False,
         do_gc: bool = False,
+        measure_mem: Optional[bool] = None,
+        gc_generation: int = 2,
     ) -> Callable[[FunctionType], FunctionType]:
+        check_gc_generation(gc_generation)
+
         def make_timed_func(func: FunctionType) -> FunctionType:
+            if not print_args:
+                # print_args needs the call as written, so it can't be specialized.
+                specialized = specialized_wrapper(
+                    func,
+                    functools.partial(
+                        self.ctx,
+                        func.__qualname__,
+                        "",
+                        print_start,
+                        print_stop,
+                        do_gc,
+                        measure_mem,
+                        gc_generation,
+                    ),
+                )
+                if specialized is not None:
+                    return cast(FunctionType, specialized)
+
             @functools.wraps(func)
             def timed_func(*args: Any, **kwargs: Any) -> Any:
                 if print_args:
@@ -204,6 +466,8 @@ class TimeBlock:
                     print_start=print_start,
                     print_stop=print_stop,
                     do_gc=do_gc,
+                    measure_mem=measure_mem,
+                    gc_generation=gc_generation,
                 ):
                     return func(*args, **kwargs)
 
@@ -217,9 +481,13 @@ class TimeBlock:
         print_stop: bool = True,
         print_args: bool = False,
         do_gc: bool = False,
+        measure_mem: Optional[bool] = None,
+        gc_generation: int = 2,
     ) -> Callable[[AsyncFunctionType], AsyncFunctionType]:
         """Asynchronous version of decor"""
 
+        check_gc_generation(gc_generation)
+
         def make_timed_async_func(func: FunctionType) -> AsyncFunctionType:
             @functools.wraps(func)
             async def timed_func(*args: Any, **kwargs: Any) -> Any:
@@ -242,6 +510,8 @@ class TimeBlock:
                     print_start=print_start,
                     print_stop=print_stop,
                     do_gc=do_gc,
+                    measure_mem=measure_mem,
+                    gc_generation=gc_generation,
                 ):
                     return await func(*args, **kwargs)
 
@@ -250,43 +520,48 @@ class TimeBlock:
         return make_timed_async_func
 
     def format_stats(self) -> str:
-        stats = {
-            key: (
-                len(vals),
-                mean([time for time, mem in vals]),
-                stddev([time for time, mem in vals]),
-                mean([mem for time, mem in vals]),
-                stddev([mem for time, mem in vals]),
-            )
-            for key, vals in self.get_stats().items()
-        }
+        """Format the stats from `get_summary` as a table.
+
+        Blocks nested inside a still-running block on another thread
+        are merged when that thread's outermost block exits, or at its
+        first block exit once 256 records are buffered or 0.1s has
+        passed since its last merge. Until then they are not included.
+
+        """
+        stats = self.get_summary()
 
         keys = sorted(stats.keys())
-        key_field_length = max(len(" > ".join(key)) for key in keys) if keys else 0
+        key_strs = {key: " > ".join(key) for key in keys}
+        key_field_length = max(map(len, key_strs.values()), default=0)
 
         lines: List[str] = []
 
         for key in keys:
-            key_str = " > ".join(key)
-
-            n_calls = stats[key][0]
-            cumulative_time_m = stats[key][1]
-            cumulative_time_s = stats[key][2]
-            mem_m, mem_unit, mem_unit_size = mem2str(stats[key][3])
-            mem_s = stats[key][4] / mem_unit_size
+            key_str = key_strs[key]
+
+            (
+                n_calls,
+                cumulative_time_m,
+                cumulative_time_s,
+                mem_mean,
+                mem_std,
+            ) = stats[key]
+            mem_m, mem_unit, mem_unit_size = mem2str(mem_mean)
+            mem_s = mem_std / mem_unit_size
             percall_time_m = cumulative_time_m / n_calls
             percall_time_s = cumulative_time_s * n_calls
 
-            parent = key[:-1]
-            if parent in stats:
-                parent_total_time_m = stats[parent][1]
-                percent_parent = cumulative_time_m / parent_total_time_m * 100
+            parent = stats.get(key[:-1])
+            if parent is not None:
+                percent_parent = cumulative_time_m / parent[1] * 100
             else:
                 percent_parent = 100
 
-            total = key[:2]
-            total_time_m = stats[total][1]
-            percent_total = cumulative_time_m / total_time_m * 100
+            total = stats.get(key[:2])
+            if total is not None:
+                percent_total = cumulative_time_m / total[1] * 100
+            else:
+                percent_total = 100
 
             lines.append(
                 " = ".join(
@@ -304,7 +579,10 @@ class TimeBlock:
         return "\n".join(lines)
 
     def print_stats(self) -> None:
-        """
+        """Print `format_stats`.
+
+        Like `get_summary`, this may not yet include blocks nested in
+        a still-running block on another thread.
 
         >>> import charmonium.time_block as ch_time_block
         >>> ch_time_block.disable_stderr()
@@ -357,6 +635,21 @@ class TimeBlock:
         """
         with self.lock:
             self.stats.clear()
+            # Other threads may hold pending records; make _flush drop them.
+            self.epoch += 1
+        self.data.pending.clear()
+
+    def set_default_measure_mem(self, measure_mem: bool) -> None:
+        """Set whether blocks measure memory usage when not specified."""
+        self.measure_mem = measure_mem
+
+    def set_async_mode(self, async_mode: bool) -> None:
+        """Set whether blocks are tracked per asyncio task.
+
+        See `TimeBlock.__init__`.
+
+        """
+        self.async_mode = async_mode
 
     def enable_stderr(self) -> None:
         self.logger.addHandler(self.handler)
@@ -1,6 +1,16 @@
 import math
 import re
-from typing import Callable, List, Tuple, cast
+from typing import Callable, List, Optional, Tuple, cast
+
+try:
+    import numpy  # type: ignore
+except ImportError:
+    numpy = None  # type: ignore
+
+# Below this many samples, NumPy's conversion overhead outweighs its speedup.
+_NUMPY_THRESHOLD = 64
+# stddev converts its list for a single statistic, so it needs more samples to win.
+_NUMPY_STDDEV_THRESHOLD = 1024
 
 
 def mem2str(
@@ -14,6 +24,11 @@ def mem2str(
         "GB",
         "TB",
     ]
+    if base2 and not round_up and isinstance(n_bytes, int):
+        # floor(log_1024(n)) is just the bit-length in groups of 10.
+        unit_int = min(len(unit_map) - 1, max(0, (abs(n_bytes).bit_length() - 1) // 10))
+        unit_div = 1 << (10 * unit_int)
+        return n_bytes / unit_div, unit_map[unit_int], unit_div
     base = 1024 if base2 else 1000
     unit_int = (
         min([len(unit_map) - 1, int(rounder(math.log(math.fabs(n_bytes), base)))])
@@ -28,14 +43,121 @@ def mean(lst: List[float]) -> float:
     return sum(lst) / len(lst)
 
 
-def stddev(lst: List[float], ddof: int = 1) -> float:
-    if len(lst) != 1:
-        m = mean(lst)
-        return math.sqrt(sum((x - m) ** 2 for x in lst) / (len(lst) - ddof))
+def stddev(lst: List[float], ddof: int = 1, mean: Optional[float] = None) -> float:
+    """Standard deviation of `lst`.
+
+    Pass `mean` if it is already known to save a pass over `lst`.
+
+    """
+    # pylint: disable=redefined-outer-name
+    if numpy is not None and len(lst) > _NUMPY_STDDEV_THRESHOLD:
+        arr = numpy.asarray(lst, dtype=numpy.float64)
+        m = arr.mean() if mean is None else mean
+        deviations = arr - m
+        return float(numpy.sqrt(numpy.dot(deviations, deviations) / (len(lst) - ddof)))
+    elif len(lst) != 1:
+        m = sum(lst) / len(lst) if mean is None else mean
+        return math.sqrt(sum([(x - m) * (x - m) for x in lst]) / (len(lst) - ddof))
     else:
         return 0
 
 
+def _combine(
+    n_a: int, mean_a: float, m2_a: float, n_b: int, mean_b: float, m2_b: float
+) -> Tuple[float, float]:
+    # Chan et al.'s update for merging two (count, mean, sum of squared deviations).
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    return mean_a + delta * n_b / n, m2_a + m2_b + delta * delta * n_a * n_b / n
+
+
+class RunningStats:
+    """Count, mean, and variance of (duration, mem) samples.
+
+    This uses Welford's online algorithm, so it takes constant memory
+    regardless of how many samples are added. If `detailed`, the raw
+    samples are kept as well.
+
+    >>> from charmonium.time_block.utils import RunningStats
+    >>> stats = RunningStats()
+    >>> stats.extend([(1.0, 10), (3.0, 30)])
+    >>> stats.add(2.0, 20)
+    >>> stats.n, stats.time_mean, stats.time_stddev(), stats.mem_mean
+    (3, 2.0, 1.0, 20.0)
+
+    """
+
+    __slots__ = (
+        "n",
+        "time_mean",
+        "time_m2",
+        "mem_mean",
+        "mem_m2",
+        "detailed",
+        "samples",
+    )
+
+    def __init__(self, detailed: bool = False) -> None:
+        self.n = 0
+        self.time_mean = 0.0
+        self.time_m2 = 0.0
+        self.mem_mean = 0.0
+        self.mem_m2 = 0.0
+        self.detailed = detailed
+        self.samples: List[Tuple[float, int]] = []
+
+    def add(self, duration: float, mem: int) -> None:
+        self.n += 1
+        delta = duration - self.time_mean
+        self.time_mean += delta / self.n
+        self.time_m2 += delta * (duration - self.time_mean)
+        delta = mem - self.mem_mean
+        self.mem_mean += delta / self.n
+        self.mem_m2 += delta * (mem - self.mem_mean)
+        if self.detailed:
+            self.samples.append((duration, mem))
+
+    def extend(self, samples: List[Tuple[float, int]]) -> None:
+        if not samples:
+            return
+        n = len(samples)
+        if numpy is not None and n > _NUMPY_THRESHOLD:
+            arr = numpy.asarray(samples, dtype=numpy.float64)
+            time_mean, mem_mean = (float(x) for x in arr.mean(axis=0))
+            time_m2, mem_m2 = (float(x) * n for x in arr.var(axis=0))
+        else:
+            times = [duration for duration, mem in samples]
+            mems = [float(mem) for duration, mem in samples]
+            time_mean = mean(times)
+            time_m2 = sum([(x - time_mean) * (x - time_mean) for x in times])
+            mem_mean = mean(mems)
+            mem_m2 = sum([(x - mem_mean) * (x - mem_mean) for x in mems])
+        self.time_mean, self.time_m2 = _combine(
+            self.n, self.time_mean, self.time_m2, n, time_mean, time_m2
+        )
+        self.mem_mean, self.mem_m2 = _combine(
+            self.n, self.mem_mean, self.mem_m2, n, mem_mean, mem_m2
+        )
+        self.n += n
+        if self.detailed:
+            self.samples.extend(samples)
+
+    def time_stddev(self, ddof: int = 1) -> float:
+        if self.n > ddof:
+            return math.sqrt(max(0.0, self.time_m2) / (self.n - ddof))
+        else:
+            return 0
+
+    def mem_stddev(self, ddof: int = 1) -> float:
+        if self.n > ddof:
+            return math.sqrt(max(0.0, self.mem_m2) / (self.n - ddof))
+        else:
+            return 0
+
+
+_NON_IDENTIFIER = re.compile(r"[^a-zA-Z0-9_]+")
+
+
 def python_sanitize(name: str) -> str:
     """Converts `name` to a valid Python identifier.
 
@@ -56,9 +178,10 @@ def python_sanitize(name: str) -> str:
     'a_b'
 
     """
-    name = re.sub(r"([^a-zA-Z0-9_]+)", "_", name)
-    name = re.sub(r"^[0-9]", r"_\g<0>", name)
+    name = _NON_IDENTIFIER.sub("_", name)
+    if name[:1].isdigit():
+        name = "_" + name
     return name
 
 
-__all__ = ["mem2str", "mean", "stddev"]
+__all__ = ["mem2str", "mean", "stddev", "RunningStats"]
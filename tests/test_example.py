@@ -2,12 +2,21 @@ import asyncio
 import contextlib
 import io
 import logging
+import math
+import os
 import pickle
 import re
+import subprocess
+import sys
+import threading
 import time
-from typing import Generator
+from typing import Any, AsyncGenerator, Generator, List, Tuple
+
+import psutil  # type: ignore
+import pytest
 
 import charmonium.time_block as ch_time_block
+from charmonium.time_block.utils import RunningStats, mem2str, stddev
 
 
 def check_lines(expected: str, actual: str) -> None:
@@ -132,3 +141,317 @@ def test_async() -> None:
 
 def test_pickle() -> None:
     pickle.loads(pickle.dumps(ch_time_block.TimeBlock()))
+
+
+def test_measure_mem() -> None:
+    ch_time_block.clear()
+    ch_time_block.set_default_measure_mem(False)
+    try:
+        with ch_time_block.ctx("no mem", print_start=False, print_stop=False):
+            big = [1] * 10 ** 7
+        del big
+        with ch_time_block.ctx(
+            "mem", print_start=False, print_stop=False, measure_mem=True
+        ):
+            big = [1] * 10 ** 7
+        del big
+    finally:
+        ch_time_block.set_default_measure_mem(True)
+    stats = ch_time_block.get_stats()
+    assert stats[("no mem",)] == [(stats[("no mem",)][0][0], 0)]
+    # 10**7 pointers is ~80MB; allow for some of it coming from freed memory.
+    assert stats[("mem",)][0][1] > 10 ** 7
+
+
+def test_summary() -> None:
+    time_block = ch_time_block.TimeBlock(detailed=False)
+    for _ in range(3):
+        with time_block.ctx("outer", print_start=False, print_stop=False):
+            pass
+    time_block.add_stats({("outer",): [(1.0, 0)]})
+    n_calls, time_mean, *_ = time_block.get_summary()[("outer",)]
+    assert n_calls == 4
+    assert 0.25 <= time_mean < 0.26
+    assert "outer" in time_block.format_stats()
+    with pytest.raises(ValueError):
+        time_block.get_stats()
+
+
+def test_running_stats_extend() -> None:
+    samples = [(float(i % 7), i % 5) for i in range(200)]
+    one_by_one = RunningStats()
+    for duration, mem in samples:
+        one_by_one.add(duration, mem)
+    in_bulk = RunningStats()
+    in_bulk.extend(samples[:50])
+    in_bulk.extend(samples[50:])
+    assert in_bulk.n == one_by_one.n
+    assert math.isclose(in_bulk.time_mean, one_by_one.time_mean)
+    assert math.isclose(in_bulk.time_stddev(), one_by_one.time_stddev())
+    assert math.isclose(in_bulk.mem_mean, one_by_one.mem_mean)
+    assert math.isclose(in_bulk.mem_stddev(), one_by_one.mem_stddev())
+
+
+def test_no_handlers() -> None:
+    time_block = ch_time_block.TimeBlock()
+    # A private logger, so pytest's handlers on the root logger are not seen.
+    time_block.logger = logging.getLogger("charmonium.time_block.test_no_handlers")
+    time_block.logger.propagate = False
+    time_block.logger.setLevel(logging.DEBUG)
+    calls: List[Tuple[Any, ...]] = []
+    time_block.logger.debug = lambda *args: calls.append(args)  # type: ignore
+
+    with time_block.ctx("quiet"):
+        pass
+    assert not calls
+    assert ("quiet",) in time_block.get_stats()
+
+    time_block.logger.addHandler(logging.NullHandler())
+    with time_block.ctx("loud"):
+        pass
+    assert [call[:2] for call in calls] == [
+        ("%s: running", " > loud"),
+        ("%s: %.1fs%s%s", " > loud"),
+    ]
+
+
+def test_task_stacks_dropped() -> None:
+    time_block = ch_time_block.TimeBlock()
+
+    async def work() -> None:
+        with time_block.ctx("work", print_start=False, print_stop=False):
+            await asyncio.sleep(0)
+
+    async def main() -> None:
+        await asyncio.gather(*[work() for _ in range(10)])
+
+    asyncio.run(main())
+    assert not time_block.data.stacks
+    assert len(time_block.data.stack_pool) == 10
+    assert time_block.get_summary()[("work",)][0] == 10
+
+
+def test_gc_generation() -> None:
+    time_block = ch_time_block.TimeBlock()
+    with time_block.ctx("young gc", do_gc=True, gc_generation=0):
+        pass
+    assert len(time_block.get_stats()[("young gc",)]) == 1
+
+    with pytest.raises(ValueError):
+        with time_block.ctx("bad gc", do_gc=True, gc_generation=5):
+            pass
+    with pytest.raises(ValueError):
+        time_block.decor(gc_generation=-1)
+    with pytest.raises(ValueError):
+        time_block.adecor(gc_generation=3)
+    # The rejected block must not leave a frame behind.
+    with time_block.ctx("after", print_start=False, print_stop=False):
+        pass
+    assert ("after",) in time_block.get_stats()
+
+
+def test_disabled() -> None:
+    code = """
+import charmonium.time_block as ch_time_block
+def foo(): pass
+assert ch_time_block.decor(print_args=True)(foo) is foo
+with ch_time_block.ctx("foo"):
+    pass
+@ch_time_block.ctx("bar")
+def bar(x):
+    return x + 1
+assert bar(1) == 2
+assert not ch_time_block.get_stats()
+"""
+    env = {**os.environ, "CH_TIME_BLOCK_DISABLED": "1"}
+    subprocess.run([sys.executable, "-c", code], env=env, check=True)
+
+
+def test_nested_stats_visible() -> None:
+    time_block = ch_time_block.TimeBlock()
+    with time_block.ctx("outer", print_start=False, print_stop=False):
+        with time_block.ctx("inner", print_start=False, print_stop=False):
+            pass
+        assert ("outer", "inner") in time_block.get_stats()
+    assert ("outer",) in time_block.get_stats()
+
+
+def test_decor_signature() -> None:
+    time_block = ch_time_block.TimeBlock()
+
+    @time_block.decor(print_start=False, print_stop=False)
+    def func(
+        a: int, b: List[int] = [], *args: int, c: int = 3, **kwargs: int
+    ) -> Tuple[Any, ...]:
+        return (a, b, args, c, kwargs)
+
+    class Klass:
+        @time_block.decor(print_start=False, print_stop=False)
+        def method(self, x: int) -> int:
+            return x + 1
+
+    assert func(1) == (1, [], (), 3, {})
+    assert func(1)[1] is func.__wrapped__.__defaults__[0]  # type: ignore
+    assert func(1, [2], 3, 4, c=5, d=6) == (1, [2], (3, 4), 5, {"d": 6})
+    assert func(b=[2], a=1) == (1, [2], (), 3, {})
+    assert Klass().method(1) == 2
+    assert func.__name__ == "func"
+    with pytest.raises(TypeError):
+        func()  # type: ignore
+    summary = time_block.get_summary()
+    # The bad call is rejected by the wrapper's signature, so it is not recorded.
+    assert summary[("test_decor_signature.<locals>.func",)][0] == 4
+    assert summary[("test_decor_signature.<locals>.Klass.method",)][0] == 1
+
+
+def test_sync_mode() -> None:
+    time_block = ch_time_block.TimeBlock(async_mode=False)
+    with time_block.ctx("outer", print_start=False, print_stop=False):
+        with time_block.ctx("inner", print_start=False, print_stop=False):
+            pass
+    assert set(time_block.get_stats()) == {("outer",), ("outer", "inner")}
+    assert list(time_block.data.stacks) == [0]
+
+    ch_time_block.set_async_mode(False)
+    try:
+        assert not ch_time_block._time_block.async_mode
+        with ch_time_block.ctx("sync mode", print_start=False, print_stop=False):
+            with ch_time_block.ctx("inner", print_start=False, print_stop=False):
+                pass
+        assert ("sync mode", "inner") in ch_time_block.get_stats()
+    finally:
+        ch_time_block.set_async_mode(True)
+
+
+def test_rss() -> None:
+    time_block = ch_time_block.TimeBlock()
+    # Allow for a few pages of allocation between the two reads.
+    assert abs(time_block._rss() - psutil.Process().memory_info().rss) < 1 << 20
+    has_statm = ch_time_block.time_block._HAS_STATM
+    ch_time_block.time_block._HAS_STATM = False
+    try:
+        # psutil fallback, used where /proc/self/statm is not available
+        assert abs(time_block._rss() - psutil.Process().memory_info().rss) < 1 << 20
+    finally:
+        ch_time_block.time_block._HAS_STATM = has_statm
+
+
+def test_late_finalized_ctx() -> None:
+    time_block = ch_time_block.TimeBlock()
+
+    async def gen() -> AsyncGenerator[int, None]:
+        with time_block.ctx("gen", print_start=False, print_stop=False):
+            yield 1
+            yield 2
+
+    async def consume(agen: AsyncGenerator[int, None]) -> None:
+        async for _ in agen:
+            break
+
+    async def main() -> None:
+        agen = gen()
+        # The consuming task ends (and its stack is dropped) with "gen" still open.
+        await asyncio.create_task(consume(agen))
+
+        async def other() -> None:
+            with time_block.ctx("other", print_start=False, print_stop=False):
+                await agen.aclose()
+                task_id = id(asyncio.current_task())
+                assert time_block.data.stacks[task_id] == ["", "other"]
+                with time_block.ctx("inner", print_start=False, print_stop=False):
+                    pass
+
+        await asyncio.create_task(other())
+
+    asyncio.run(main())
+    assert set(time_block.get_stats()) == {("gen",), ("other",), ("other", "inner")}
+    assert not time_block.data.stacks
+    assert not time_block.data.keys
+
+
+def test_clear_drops_other_threads_pending() -> None:
+    time_block = ch_time_block.TimeBlock()
+    inner_done = threading.Event()
+    cleared = threading.Event()
+
+    def worker() -> None:
+        with time_block.ctx("outer", print_start=False, print_stop=False):
+            with time_block.ctx("before_clear", print_start=False, print_stop=False):
+                pass
+            inner_done.set()
+            cleared.wait()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    inner_done.wait()
+    time_block.clear()
+    cleared.set()
+    thread.join()
+    assert list(time_block.get_stats()) == [("outer",)]
+
+
+def test_other_thread_sees_nested_stats() -> None:
+    time_block = ch_time_block.TimeBlock()
+    inner_done = threading.Event()
+    checked = threading.Event()
+
+    def worker() -> None:
+        with time_block.ctx("outer", print_start=False, print_stop=False):
+            for _ in range(2):
+                with time_block.ctx("inner", print_start=False, print_stop=False):
+                    pass
+                time.sleep(0.15)
+            # The second exit came >0.1s after the first flush, so it was merged too.
+            inner_done.set()
+            checked.wait()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    inner_done.wait()
+    try:
+        assert time_block.get_summary()[("outer", "inner")][0] == 2
+    finally:
+        checked.set()
+        thread.join()
+
+
+def test_stddev_mean() -> None:
+    lst = [1.0, 2.0, 4.0, 8.0]
+    lst_mean = sum(lst) / len(lst)
+    for ddof in [0, 1]:
+        expected = math.sqrt(sum((x - lst_mean) ** 2 for x in lst) / (len(lst) - ddof))
+        assert math.isclose(stddev(lst, ddof=ddof), expected)
+        assert math.isclose(stddev(lst, ddof=ddof, mean=lst_mean), expected)
+    # A given mean is used as-is, not recomputed.
+    off_center = math.sqrt(sum((x - 3.0) ** 2 for x in lst) / 3)
+    assert math.isclose(stddev(lst, mean=3.0), off_center)
+
+
+def test_stddev_numpy(monkeypatch: pytest.MonkeyPatch) -> None:
+    pytest.importorskip("numpy")
+    lst = [float(i % 97) / 7 for i in range(5000)]
+    with_numpy = [stddev(lst), stddev(lst, ddof=0), stddev(lst, mean=7.0)]
+    monkeypatch.setattr(ch_time_block.utils, "numpy", None)
+    without_numpy = [stddev(lst), stddev(lst, ddof=0), stddev(lst, mean=7.0)]
+    for numpy_result, python_result in zip(with_numpy, without_numpy):
+        assert math.isclose(numpy_result, python_result)
+
+
+def test_mem2str_int_matches_float() -> None:
+    for n_bytes in [
+        0,
+        1,
+        -1,
+        1023,
+        -1023,
+        1024,
+        -1024,
+        2 ** 30 - 1,
+        2 ** 30,
+        -(2 ** 30),
+        2 ** 40,
+        3 * 2 ** 40 + 5,
+        2 ** 50,
+        -(2 ** 60),
+    ]:
+        assert mem2str(n_bytes) == mem2str(float(n_bytes))